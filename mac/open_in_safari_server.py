@@ -19,21 +19,38 @@
 # - In Edge (Windows), load the extension and set options to match PORT/TOKEN and your Mac host IP.
 #
 # Dependencies:
-# - Python standard library only (http.server, socketserver, ipaddress, json, subprocess)
+# - Python standard library only (http.server, concurrent.futures, ipaddress, json, subprocess)
+# - Optional: pytricia (radix-trie subnet lookups; falls back to stdlib ipaddress if missing)
+# - Optional: pyobjc (AppKit; opens URLs via NSWorkspace instead of spawning /usr/bin/open)
 #
 # Pip (not needed for stdlib-only script):
 # 1) cd ~/Documents && source myenv/bin/activate && pip install (none required)
 # 2) pip install (none required)
 
 import http.server
-import socketserver
 import socket
 import json
 import subprocess
 import sys
+import time
+import queue
+import threading
+import signal
 import os
 import ipaddress
-from urllib.parse import parse_qs
+import functools
+import hmac
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import pytricia
+except ImportError:
+    pytricia = None
+
+try:
+    import AppKit
+except ImportError:
+    AppKit = None
 
 # =========================
 # CONFIG (overridden by env)
@@ -45,6 +62,7 @@ CONFIG = {
     "SHARED_TOKEN": "changeme123456",
     "DRY_RUN": False,
     "VERBOSE": True,
+    "WORKERS": 1,
 }
 
 # Environment overrides (set by LaunchAgent)
@@ -53,11 +71,18 @@ def load_env_overrides():
     bind = os.environ.get("OIS_BIND")
     token = os.environ.get("OIS_TOKEN")
     subnets = os.environ.get("OIS_ALLOWED_SUBNETS")
+    workers = os.environ.get("OIS_WORKERS")
     if port:
         try:
             CONFIG["PORT"] = int(port)
         except ValueError:
             pass
+    if workers:
+        try:
+            # 0 means one worker per CPU
+            CONFIG["WORKERS"] = int(workers) or os.cpu_count() or 1
+        except ValueError:
+            pass
     if bind:
         CONFIG["BIND_ADDRESS"] = bind
     if token:
@@ -66,8 +91,30 @@ def load_env_overrides():
         CONFIG["ALLOWED_SUBNETS"] = [s.strip() for s in subnets.split(",") if s.strip()]
     CONFIG["DRY_RUN"] = os.environ.get("OIS_DRY_RUN", "false").lower() == "true"
     CONFIG["VERBOSE"] = os.environ.get("OIS_VERBOSE", "true").lower() == "true"
+    CONFIG["_TOKEN_BYTES"] = CONFIG["SHARED_TOKEN"].encode("utf-8")
+    compile_allowed_subnets()
 
-load_env_overrides()
+# Parse ALLOWED_SUBNETS once so requests don't re-parse CIDR strings
+def compile_allowed_subnets():
+    nets = []
+    for cidr in CONFIG["ALLOWED_SUBNETS"]:
+        try:
+            nets.append(ipaddress.ip_network(cidr, strict=False))
+        except ValueError:
+            print(f"WARN: ignoring invalid subnet {cidr!r}", file=sys.stderr, flush=True)
+    # (network_int, mask_int) pairs for the integer-AND fallback check
+    CONFIG["_NETS_V4"] = tuple((int(n.network_address), int(n.netmask)) for n in nets if n.version == 4)
+    CONFIG["_NETS_V6"] = tuple((int(n.network_address), int(n.netmask)) for n in nets if n.version == 6)
+    # pytricia tries are single-family, so keep one per address family
+    CONFIG["_TRIE_V4"] = CONFIG["_TRIE_V6"] = None
+    if pytricia is not None:
+        trie_v4 = pytricia.PyTricia(32)
+        trie_v6 = pytricia.PyTricia(128, socket.AF_INET6)
+        for n in nets:
+            (trie_v4 if n.version == 4 else trie_v6).insert(str(n), True)
+        CONFIG["_TRIE_V4"] = trie_v4
+        CONFIG["_TRIE_V6"] = trie_v6
+    _client_allowed_cached.cache_clear()
 
 VERSION = "1.0.0"
 
@@ -84,144 +131,359 @@ def redacted_token():
     return t[:2] + "***" + t[-2:]
 
 def client_allowed(client_ip: str) -> bool:
+    return _client_allowed_cached(client_ip)
+
+# Same few VM IPs hit the server repeatedly; cleared whenever subnets are recompiled
+@functools.lru_cache(maxsize=256)
+def _client_allowed_cached(client_ip: str) -> bool:
+    family = socket.AF_INET6 if ":" in client_ip else socket.AF_INET
     try:
-        ip_obj = ipaddress.ip_address(client_ip)
-    except ValueError:
+        packed = socket.inet_pton(family, client_ip)
+    except (OSError, ValueError):
         return False
-    for cidr in CONFIG["ALLOWED_SUBNETS"]:
+    is_v4 = family == socket.AF_INET
+    trie = CONFIG["_TRIE_V4"] if is_v4 else CONFIG["_TRIE_V6"]
+    if trie is not None:
         try:
-            if ip_obj in ipaddress.ip_network(cidr, strict=False):
-                return True
-        except ValueError:
-            continue
-    return False
+            return client_ip in trie
+        except (KeyError, ValueError):
+            return False
+    ip_int = int.from_bytes(packed, "big")
+    nets = CONFIG["_NETS_V4"] if is_v4 else CONFIG["_NETS_V6"]
+    return any(ip_int & mask == net for net, mask in nets)
 
-def open_in_safari(url: str) -> (bool, str):
+load_env_overrides()
+
+_ALLOWED_SCHEMES = ("http://", "https://")
+MAX_BODY_BYTES = 8192
+OPENED_MSG = "Opened in Safari"
+QUEUED_MSG = "Queued for Safari"
+OPEN_TIMEOUT = 10
+
+def open_in_safari(url: str, client_ip: str = "") -> (int, str):
+    """Returns (HTTP status, message); 200 opened, 202 handed to 'open', >= 400 failed."""
     # Validate scheme
-    if not (url.startswith("http://") or url.startswith("https://")):
-        return False, "Only http/https URLs are permitted."
+    if not url.startswith(_ALLOWED_SCHEMES):
+        return 500, "Only http/https URLs are permitted."
     if CONFIG["DRY_RUN"]:
         log(f"[DRY_RUN] Would open in Safari: {url}")
-        return True, "DRY_RUN: OK"
+        return 200, "DRY_RUN: OK"
     try:
+        if AppKit is not None:
+            if not workspace_open(url):
+                return 500, "NSWorkspace could not open URL"
+            return 200, OPENED_MSG
         # Use the 'open' tool to send URL to Safari
-        # 'open -a Safari <url>' opens in a new tab/window as configured
-        res = subprocess.run(
-            ["/usr/bin/open", "-a", "Safari", url],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            timeout=10
-        )
-        if res.returncode != 0:
-            return False, res.stderr.strip() or "Unknown error from 'open'"
-        return True, "Opened in Safari"
+        # 'open -a Safari <url>' opens in a new tab/window as configured.
+        # The reaper thread waits on it, so the request thread returns right away.
+        proc = spawn_open(["/usr/bin/open", "-a", "Safari", url])
+        reap_later(proc, url, client_ip)
+        return 202, QUEUED_MSG
     except Exception as e:
-        return False, str(e)
+        return 500, str(e)
+
+# In-process equivalent of 'open -a Safari <url>' (no child process).
+# openURLs:withAppBundleIdentifier:... is deprecated since macOS 11 but still works and is
+# synchronous, so its return value maps directly onto the HTTP reply. The replacement,
+# openURLs:withApplicationAtURL:configuration:completionHandler:, reports only through a
+# completion block on another queue; we'd have to block the request thread on it anyway
+# and also resolve Safari's app URL first.
+def workspace_open(url: str) -> bool:
+    nsurl = AppKit.NSURL.URLWithString_(url)
+    if nsurl is None:
+        return False
+    ok, _ = AppKit.NSWorkspace.sharedWorkspace().openURLs_withAppBundleIdentifier_options_additionalEventParamDescriptor_launchIdentifiers_(
+        [nsurl], "com.apple.Safari", AppKit.NSWorkspaceLaunchDefault, None, None
+    )
+    return bool(ok)
+
+# subprocess only takes its posix_spawn fast path when no pipes are requested and
+# close_fds is off; our own fds are non-inheritable (PEP 446) so nothing leaks.
+_DEVNULL = open(os.devnull, "wb")
+
+def spawn_open(argv: list) -> subprocess.Popen:
+    return subprocess.Popen(argv, stdout=_DEVNULL, stderr=_DEVNULL, close_fds=False)
+
+# Spawned 'open' processes waiting to be reaped: (proc, url, client_ip, started)
+_REAP_QUEUE = queue.Queue()
+_reaper_lock = threading.Lock()
+_reaper_pid = None
+
+def reap_later(proc: subprocess.Popen, url: str, client_ip: str):
+    global _reaper_pid
+    with _reaper_lock:
+        # Threads don't survive fork(), so each worker process starts its own
+        if _reaper_pid != os.getpid():
+            threading.Thread(target=_reap_forever, name="ois-reaper", daemon=True).start()
+            _reaper_pid = os.getpid()
+    _REAP_QUEUE.put((proc, url, client_ip, time.monotonic()))
+
+def _reap_forever():
+    while True:
+        proc, url, client_ip, started = _REAP_QUEUE.get()
+        try:
+            proc.wait(timeout=max(0, started + OPEN_TIMEOUT - time.monotonic()))
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+            log(f"ERR: {client_ip} -> {url}: 'open' timed out after {OPEN_TIMEOUT}s")
+            continue
+        if proc.returncode != 0:
+            log(f"ERR: {client_ip} -> {url}: 'open' exited with status {proc.returncode}")
+
+_CORS_HEADERS = (
+    b"Access-Control-Allow-Origin: *\r\n"
+    b"Access-Control-Allow-Methods: GET, POST, OPTIONS\r\n"
+    b"Access-Control-Allow-Headers: Content-Type, X-OpenInSafari-Token\r\n"
+)
+
+_JSON_CONTENT_TYPE = b"Content-Type: application/json; charset=utf-8\r\n"
+
+# Header block shared by every JSON response (after Server/Date)
+def json_headers(length: int, close: bool) -> bytes:
+    return (
+        _CORS_HEADERS + _JSON_CONTENT_TYPE
+        + b"Content-Length: %d\r\n" % length
+        + (b"Connection: close\r\n" if close else b"Connection: keep-alive\r\n")
+    )
+
+def ping_body(client_ip: str, allowed: bool, token_ok: bool) -> bytes:
+    return json.dumps({
+        "ok": bool(token_ok and allowed),
+        "version": VERSION,
+        "client_ip": client_ip,
+        "allowed": allowed,
+        "token_ok": bool(token_ok)
+    }).encode("utf-8")
+
+# Pre-encoded bodies for the fixed responses
+_MSG_FORBIDDEN = json.dumps({"ok": False, "error": "Forbidden: Client IP not allowed"}).encode("utf-8")
+_MSG_UNAUTH = json.dumps({"ok": False, "error": "Unauthorized: Bad token"}).encode("utf-8")
+_MSG_NOT_FOUND = json.dumps({"ok": False, "error": "Not Found"}).encode("utf-8")
+_MSG_OPEN_OK = json.dumps({"ok": True, "message": OPENED_MSG}).encode("utf-8")
+_MSG_OPEN_QUEUED = json.dumps({"ok": True, "message": QUEUED_MSG}).encode("utf-8")
+# Only picks a cached body; the status code always comes from open_in_safari()
+_OPEN_BODIES = {OPENED_MSG: _MSG_OPEN_OK, QUEUED_MSG: _MSG_OPEN_QUEUED}
 
 class Handler(http.server.BaseHTTPRequestHandler):
     server_version = f"OpenInSafariServer/{VERSION}"
+    # Keep-alive lets the extension's /ping polls reuse one TCP connection
+    protocol_version = "HTTP/1.1"
+    # Each open connection holds a pool thread, so idle keep-alive sockets are
+    # closed quickly; the extension's pings still reuse a connection within this window
+    timeout = 3
+
+    def log_message(self, format, *args):
+        # Access log goes through log() so OIS_VERBOSE=false silences it too
+        log(f"{self.client_address[0]} - {format % args}")
 
     def _set_cors(self):
-        self.send_header("Access-Control-Allow-Origin", "*")
-        self.send_header("Access-Control-Allow-Methods", "GET, POST, OPTIONS")
-        self.send_header("Access-Control-Allow-Headers", "Content-Type, X-OpenInSafari-Token")
+        # Appends the pre-encoded block directly, as send_header() would line by line
+        if self.request_version != "HTTP/0.9":
+            self._headers_buffer.append(_CORS_HEADERS)
 
     def do_OPTIONS(self):
         self.send_response(204)
         self._set_cors()
+        self.send_header("Content-Length", "0")
         self.end_headers()
 
     def _read_json(self):
-        length = int(self.headers.get("Content-Length", "0") or 0)
+        # The extension always posts JSON; anything else reads as empty.
+        # Returns None once an oversized body has been rejected with 413.
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+        except ValueError:
+            self.close_connection = True
+            return {}
         if length <= 0:
             return {}
-        raw = self.rfile.read(length)
+        if length > MAX_BODY_BYTES:
+            # Refuse before reading; _reject() also closes the connection
+            self._reject(413, "Payload too large")
+            return None
+        raw = self.rfile.read(min(length, MAX_BODY_BYTES))
         try:
-            return json.loads(raw.decode("utf-8"))
-        except Exception:
-            # try form-encoded
-            try:
-                data = parse_qs(raw.decode("utf-8"))
-                return {k: v[0] for k, v in data.items()}
-            except Exception:
-                return {}
+            data = json.loads(raw)
+        except (ValueError, RecursionError):
+            return {}
+        return data if isinstance(data, dict) else {}
 
-    def _reject(self, code: int, msg: str):
-        try:
-            self.send_response(code)
-            self._set_cors()
-            self.send_header("Content-Type", "application/json; charset=utf-8")
-            self.end_headers()
-            self.wfile.write(json.dumps({"ok": False, "error": msg}).encode("utf-8"))
-        except BrokenPipeError:
-            pass
+    def _reject(self, code: int, msg: str, body: bytes = None):
+        if body is None:
+            body = json.dumps({"ok": False, "error": msg}).encode("utf-8")
+        if self.command == "POST":
+            # A rejected POST may not have had its body read
+            self.close_connection = True
+        self._send_json(code, body)
+
+    def _ok(self, payload: dict, body: bytes = None):
+        if body is None:
+            body = json.dumps(payload).encode("utf-8")
+        self._send_json(200, body)
 
-    def _ok(self, payload: dict):
+    def _send_json(self, code: int, body: bytes):
         try:
-            self.send_response(200)
-            self._set_cors()
-            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_response(code)
+            if self.request_version != "HTTP/0.9":
+                self._headers_buffer.append(json_headers(len(body), self.close_connection))
             self.end_headers()
-            self.wfile.write(json.dumps(payload).encode("utf-8"))
+            self.wfile.write(body)
         except BrokenPipeError:
-            pass
+            self.close_connection = True
 
     def _extract_token(self) -> str:
         return self.headers.get("X-OpenInSafari-Token", "")
 
+    def _token_ok(self) -> bool:
+        # Header values arrive latin-1 decoded; re-encode to recover the raw bytes
+        token = self._extract_token().encode("latin-1", "replace")
+        return hmac.compare_digest(token, CONFIG["_TOKEN_BYTES"])
+
     def _client_ip(self) -> str:
         return self.client_address[0]
 
     def do_GET(self):
-        if self.path.startswith("/ping"):
-            client_ip = self._client_ip()
-            token_ok = (self._extract_token() == CONFIG["SHARED_TOKEN"]) if CONFIG["SHARED_TOKEN"] else True
-            allowed = client_allowed(client_ip)
-            payload = {
-                "ok": bool(token_ok and allowed),
-                "version": VERSION,
-                "client_ip": client_ip,
-                "allowed": allowed,
-                "token_ok": bool(token_ok)
-            }
-            self._ok(payload)
+        handler = _GET_ROUTES.get(self.path.partition("?")[0])
+        if handler is None:
+            return self._reject(404, "Not Found", _MSG_NOT_FOUND)
+        handler(self)
+
+    def _ping_handler(self):
+        if self._ping_fast():
             return
-        self._reject(404, "Not Found")
+        client_ip = self._client_ip()
+        token_ok = self._token_ok() if CONFIG["SHARED_TOKEN"] else True
+        allowed = client_allowed(client_ip)
+        self._ok(None, ping_body(client_ip, allowed, token_ok))
+
+    def _ping_fast(self) -> bool:
+        # Allowed client with a good token: write the whole cached response at once
+        client_ip = self._client_ip()
+        if self.close_connection or not client_allowed(client_ip):
+            return False
+        if CONFIG["SHARED_TOKEN"] and not self._token_ok():
+            return False
+        head, tail = self._ping_ok_parts(client_ip)
+        try:
+            self.wfile.write(head + self.date_time_string().encode("latin-1") + tail)
+        except BrokenPipeError:
+            self.close_connection = True
+        self.log_request(200)
+        return True
+
+    def _ping_ok_parts(self, client_ip: str) -> (bytes, bytes):
+        # Status line and Server header as send_response() writes them; Date goes between
+        head = (
+            f"{self.protocol_version} 200 {self.responses[200][0]}\r\n"
+            f"Server: {self.version_string()}\r\nDate: "
+        ).encode("latin-1")
+        return _ping_ok_response(head, client_ip)
 
     def do_POST(self):
         client_ip = self._client_ip()
         if not client_allowed(client_ip):
             log(f"DENY: client {client_ip} not in allowed subnets {CONFIG['ALLOWED_SUBNETS']}")
-            return self._reject(403, "Forbidden: Client IP not allowed")
+            return self._reject(403, "Forbidden: Client IP not allowed", _MSG_FORBIDDEN)
         if CONFIG["SHARED_TOKEN"]:
-            token = self._extract_token()
-            if token != CONFIG["SHARED_TOKEN"]:
+            if not self._token_ok():
                 log("DENY: token mismatch [redacted]")
-                return self._reject(401, "Unauthorized: Bad token")
-        if self.path.startswith("/open"):
-            data = self._read_json()
-            url = (data.get("url") or "").strip()
-            if not url:
-                return self._reject(400, "Missing 'url'")
-            ok, msg = open_in_safari(url)
-            if ok:
-                log(f"OK: {client_ip} -> {url}")
-                return self._ok({"ok": True, "message": msg})
-            else:
-                log(f"ERR: {client_ip} -> {url}: {msg}")
-                return self._reject(500, msg)
-        return self._reject(404, "Not Found")
-
-class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
-    daemon_threads = True
+                return self._reject(401, "Unauthorized: Bad token", _MSG_UNAUTH)
+        handler = _POST_ROUTES.get(self.path.partition("?")[0])
+        if handler is None:
+            return self._reject(404, "Not Found", _MSG_NOT_FOUND)
+        handler(self)
+
+    def _open_handler(self):
+        client_ip = self._client_ip()
+        data = self._read_json()
+        if data is None:
+            return
+        url = data.get("url") or ""
+        if not isinstance(url, str):
+            return self._reject(400, "'url' must be a string")
+        url = url.strip()
+        if not url:
+            return self._reject(400, "Missing 'url'")
+        code, msg = open_in_safari(url, client_ip)
+        if code >= 400:
+            log(f"ERR: {client_ip} -> {url}: {msg}")
+            return self._reject(code, msg)
+        log(f"OK: {client_ip} -> {url}")
+        body = _OPEN_BODIES.get(msg) or json.dumps({"ok": True, "message": msg}).encode("utf-8")
+        self._send_json(code, body)
+
+# Pre-encoded (head, tail) of a successful /ping per client IP, bounded like the
+# client_allowed cache
+@functools.lru_cache(maxsize=256)
+def _ping_ok_response(head: bytes, client_ip: str) -> (bytes, bytes):
+    body = ping_body(client_ip, True, True)
+    return head, b"\r\n" + json_headers(len(body), False) + b"\r\n" + body
+
+# Exact-path dispatch (query string stripped)
+_GET_ROUTES = {"/ping": Handler._ping_handler}
+_POST_ROUTES = {"/open": Handler._open_handler}
+
+# Pre-fork extra worker processes that accept() on the already-listening socket
+def fork_workers(httpd, count: int) -> list:
+    pids = []
+    for _ in range(count - 1):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                httpd.serve_forever(poll_interval=0.5)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                os._exit(0)
+        pids.append(pid)
+    return pids
+
+class PooledHTTPServer(http.server.HTTPServer):
+    """HTTPServer that handles requests on a bounded, reused thread pool."""
     allow_reuse_address = True
+    max_threads = 32
+    # Accepted connections allowed to wait for a free thread; beyond this they are closed
+    max_pending = 32
+
+    def server_activate(self):
+        super().server_activate()
+        self._pool = ThreadPoolExecutor(max_workers=self.max_threads, thread_name_prefix="ois")
+        self._slots = threading.BoundedSemaphore(self.max_threads + self.max_pending)
+
+    def verify_request(self, request, client_address):
+        # Drop disallowed clients before they can occupy a pool thread
+        if client_allowed(client_address[0]):
+            return True
+        log(f"DENY: connection from {client_address[0]} (not in allowed subnets)")
+        return False
+
+    def process_request(self, request, client_address):
+        if not self._slots.acquire(blocking=False):
+            log(f"BUSY: dropping connection from {client_address[0]}")
+            self.shutdown_request(request)
+            return
+        self._pool.submit(self._handle, request, client_address)
+
+    def _handle(self, request, client_address):
+        # Same per-request lifecycle as socketserver.ThreadingMixIn.process_request_thread
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def server_close(self):
+        super().server_close()
+        self._pool.shutdown(wait=False)
 
 def main():
     bind = CONFIG["BIND_ADDRESS"]
     port = CONFIG["PORT"]
     try:
-        httpd = ThreadingHTTPServer((bind, port), Handler)
+        httpd = PooledHTTPServer((bind, port), Handler)
     except OSError as e:
         print(f"Failed to bind {bind}:{port}: {e}", file=sys.stderr, flush=True)
         sys.exit(1)
@@ -240,11 +502,27 @@ def main():
     print(f"Hostname: {host_name}", flush=True)
     print("Endpoints: POST /open, GET /ping", flush=True)
 
+    workers = max(1, CONFIG["WORKERS"])
+    if workers > 1 and AppKit is not None:
+        # Cocoa is not fork-safe once loaded
+        log("WARN: pyobjc/AppKit loaded; running a single worker process")
+        workers = 1
+    print(f"Workers: {workers}", flush=True)
+    pids = fork_workers(httpd, workers)
+    if pids:
+        # Let launchd's SIGTERM reach the finally block so workers are stopped too
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
     try:
         httpd.serve_forever(poll_interval=0.5)
     except KeyboardInterrupt:
         pass
     finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
         httpd.server_close()
 
 if __name__ == "__main__":